@@ -0,0 +1,65 @@
+import dataclasses
+import functools
+import threading
+from collections import OrderedDict
+from typing import Optional
+import orjson
+
+
+@dataclasses.dataclass(slots=True)
+class RAGState:
+    """The user's choices and the conversation status shared by all the agents."""
+    input_dir: Optional[str] = None
+    chunk_size: Optional[int] = None
+    chunk_overlap: Optional[int] = None
+    embedding_model: Optional[str] = None
+    reranking_model: Optional[str] = None
+    search_type: Optional[str] = None
+    query: Optional[str] = None
+    batch_size: Optional[int] = None
+    parallel: Optional[int] = None
+    current_speaker: Optional[str] = None
+    just_finished: bool = False
+    response: Optional[str] = None
+
+def state_snapshot(state: RAGState) -> tuple:
+    """Return a hashable snapshot of the current values in the state."""
+    return dataclasses.astuple(state)
+
+def format_state(state: RAGState) -> str:
+    """Render the state as compact JSON for the agents' system prompts."""
+    return orjson.dumps(state).decode()
+
+AGENT_CACHE_SIZE = 16
+
+def cache_by_state(factory):
+    """
+    Reuse the agent built by the factory until the state it was built from changes.
+    The tools of the cached agent keep a reference to the live state, so they still see its updates.
+    Only the agents of the AGENT_CACHE_SIZE most recently used states are kept.
+    """
+    # A WeakKeyDictionary would never release a state, because the cached agent's tools reference it.
+    # Keying on id(state) is safe: while an entry is cached its agent keeps that state alive,
+    # so the id cannot be reused by another state.
+    cache = OrderedDict()
+    # Streamlit runs each session in its own thread, and they all share this cache
+    lock = threading.Lock()
+
+    @functools.wraps(factory)
+    def wrapper(state: RAGState, **options):
+        snapshot = (state_snapshot(state), tuple(sorted(options.items())))
+        with lock:
+            cached = cache.get(id(state))
+            if cached is not None and cached[0] == snapshot:
+                cache.move_to_end(id(state))
+                return cached[1]
+        # Build the agent outside the lock, so other sessions are not blocked meanwhile
+        agent = factory(state, **options)
+        with lock:
+            cache[id(state)] = (snapshot, agent)
+            cache.move_to_end(id(state))
+            if len(cache) > AGENT_CACHE_SIZE:
+                cache.popitem(last=False)
+        return agent
+
+    return wrapper
@@ -1,16 +1,16 @@
 import streamlit as st
-from main import orchestration_agent_factory, get_initial_state, Speaker
+from main import orchestration_agent_factory, get_root_memory, route_by_rules, Speaker
 from main import concierge_agent_factory
 from main import continuation_agent_factory
 from colorama import Fore, Style
 
-from llama_index.core.memory import ChatMemoryBuffer
 from llama_index.core.tools import FunctionTool
 from llama_index.llms.openai import OpenAI 
 from llama_index.agent.openai import OpenAIAgent
 from document_pre_processing_agent import DocumentPreprocessingAgent
 from indexing_agent import QdrantIndexingAgent
 from generation_agent import GenerationAgent
+from agent_state import RAGState
 
 # Title
 st.set_page_config(page_title="Customize RAG with Multi Agents using Llamaindex and Qdrant", layout="wide")
@@ -22,11 +22,11 @@ if "messages" not in st.session_state:
 
 # Initialize state
 if "state" not in st.session_state:
-    st.session_state.state = get_initial_state()
+    st.session_state.state = RAGState()
 
 # Initialize root memory
 if "root_memory" not in st.session_state:
-    st.session_state.root_memory = ChatMemoryBuffer.from_defaults(token_limit=125000)
+    st.session_state.root_memory = get_root_memory()
 
 # Display chat messages from history on app rerun
 for message in st.session_state.messages:
@@ -45,28 +45,30 @@ if user_msg_str:
 
     current_history = st.session_state.root_memory.get()
 
-    if st.session_state.state["current_speaker"]:
-        next_speaker = st.session_state.state["current_speaker"]
+    if st.session_state.state.current_speaker:
+        next_speaker = st.session_state.state.current_speaker
     else:
-        orchestration_response = orchestration_agent_factory(st.session_state.state).chat(user_msg_str, chat_history=current_history)
-        next_speaker = str(orchestration_response).strip()
+        next_speaker = route_by_rules(st.session_state.state, user_msg_str)
+        if next_speaker is None:
+            orchestration_response = orchestration_agent_factory(st.session_state.state).chat(user_msg_str, chat_history=current_history)
+            next_speaker = str(orchestration_response).strip()
 
     # Select the current speaker
     if next_speaker == Speaker.Data_pre_processing:
         current_speaker = DocumentPreprocessingAgent(st.session_state.state)
-        st.session_state.state["current_speaker"] = next_speaker
+        st.session_state.state.current_speaker = next_speaker
     elif next_speaker == Speaker.Indexing:
         current_speaker = QdrantIndexingAgent(st.session_state.state)
-        st.session_state.state["current_speaker"] = next_speaker
+        st.session_state.state.current_speaker = next_speaker
     elif next_speaker == Speaker.Generation:
         current_speaker = GenerationAgent(st.session_state.state)
-        st.session_state.state["current_speaker"] = next_speaker
+        st.session_state.state.current_speaker = next_speaker
     elif next_speaker == Speaker.Concierge:
         current_speaker = concierge_agent_factory(st.session_state.state)
     else:
         st.write("Orchestration agent failed to return a valid speaker; ask it to try again")
-        st.session_state.state["current_speaker"] = None
-        st.session_state.state["just_finished"] = False
+        st.session_state.state.current_speaker = None
+        st.session_state.state.just_finished = False
         st.rerun()
 
     # Chat with the current speaker
@@ -1,7 +1,6 @@
 from dotenv import load_dotenv
 load_dotenv()
 from typing import List
-import pprint
 
 from llama_index.core.memory import ChatMemoryBuffer
 from llama_index.core.tools import FunctionTool
@@ -9,102 +8,137 @@ from llama_index.llms.openai import OpenAI
 from llama_index.agent.openai import OpenAIAgent
 
 import os
-import json
 import re
+import functools
+import orjson
+import threading
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from llama_index.core.schema import Document
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.core import SimpleDirectoryReader
+from agent_state import RAGState, cache_by_state, format_state
 
+_LLM = OpenAI(model="gpt-3.5-turbo")
 
+_WS_RE = re.compile(r'\s+')
+_PUNCT_RE = re.compile(r'[^\w\s]+')
 
-def documents_transformation(input_dir: str):
+
+def _normalize(doc: Document) -> Document:
+    transformed_content = _PUNCT_RE.sub('', _WS_RE.sub(' ', doc.get_content().lower()))
+    return Document(text=transformed_content, metadata=doc.metadata)
+
+def _normalize_file(documents: List[Document]) -> List[Document]:
+    return [_normalize(doc) for doc in documents]
+
+@functools.lru_cache(maxsize=1)
+def _get_splitter(chunk_size, chunk_overlap) -> SentenceSplitter:
+    # The sentence tokenizer is loaded once per chunking configuration in each worker process
+    return SentenceSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap
+    )
+
+def _process_file(documents: List[Document], chunk_size, chunk_overlap):
+    # Normalize and split in the same worker, so the file's text crosses processes only once each way
+    return _get_splitter(chunk_size, chunk_overlap).get_nodes_from_documents(_normalize_file(documents))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor() -> ProcessPoolExecutor:
+    """
+    Return the process pool shared by every pre-processing call.
+    The workers stay alive, so they are started once and keep their cached splitters.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+        return _executor
+
+def _reset_executor() -> None:
+    global _executor
+    with _executor_lock:
+        _executor = None
+
+def documents_to_nodes(input_dir: str, chunk_size, chunk_overlap):
     print(f"Input directory: {input_dir}")
-    documents = SimpleDirectoryReader(input_dir=input_dir).load_data()
-    print(f"Loaded {len(documents)} documents")
-    transformed_documents = []
-    for doc in documents:
-        transformed_content = doc.get_content().lower()
-        transformed_content = re.sub(r'\s+', ' ', transformed_content)
-        transformed_content = re.sub(r'[^\w\s]', '', transformed_content)
-        transformed_documents.append(Document(text=transformed_content, metadata=doc.metadata))
-    print(f"Transformed {len(documents)} documents")
-    return transformed_documents
-
-def split_documents_into_nodes(documents, chunk_size, chunk_overlap):
+    reader = SimpleDirectoryReader(input_dir=input_dir)
+    executor = _get_executor()
     try:
-        splitter = SentenceSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap
-        )
-        nodes = splitter.get_nodes_from_documents(documents)
-        return nodes
+        # Each file is transformed and split in a worker while the next one is being loaded
+        futures = [executor.submit(_process_file, documents, chunk_size, chunk_overlap) for documents in reader.iter_data()]
+        nodes = [node for future in futures for node in future.result()]
     except Exception as e:
-        print(f"Error splitting documents into nodes: {e}")
+        if isinstance(e, BrokenProcessPool):
+            # A worker died, so the next call starts a fresh pool
+            _reset_executor()
+        print(f"Error transforming documents into nodes: {e}")
         return []
+    print(f"Loaded and transformed {len(futures)} files into {len(nodes)} nodes")
+    return nodes
 
 def save_nodes(nodes, input_dir):
     try:
-        input_dir = input_dir
-        output_file = os.path.join(input_dir, 'nodes.json')
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        nodes_dict = [node.dict() for node in nodes]
-        with open(output_file, 'w') as file:
-            json.dump(nodes_dict, file, indent=4)
+        output_file = Path(input_dir) / 'nodes.json'
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        options = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        with open(output_file, 'wb') as file:
+            file.write(b'[')
+            for i, node in enumerate(nodes):
+                if i:
+                    file.write(b',')
+                file.write(orjson.dumps(node.dict(), option=options))
+            file.write(b']')
         print(f"Saved nodes to {output_file}")
     except Exception as e:
         print(f"Error saving nodes to file: {e}")
 
+PREPROCESSING_PARAMETERS = ("input_dir", "chunk_size", "chunk_overlap")
+
+def get_missing_parameters(state: RAGState) -> List[str]:
+    """Return the pre-processing parameters that have not been specified yet."""
+    return [key for key in PREPROCESSING_PARAMETERS if getattr(state, key) is None]
+
     
 class preprocess_docs:
-    def __init__(self, state: dict):
+    def __init__(self, state: RAGState):
         self.state = state
-        self.input_dir = state.get('input_dir')
-        self.chunk_size = state.get('chunk_size')
-        self.chunk_overlap = state.get('chunk_overlap')
         
     def process_documents(self) -> None:
-        input_dir = rf"{self.input_dir}"
-        documents = documents_transformation(self.input_dir)
-        print("Document Transformation is done")
-        nodes = split_documents_into_nodes(documents, self.chunk_size, self.chunk_overlap)
+        # Read the parameters now, they may have been recorded earlier in the same turn
+        input_dir = self.state.input_dir
+        nodes = documents_to_nodes(input_dir, self.state.chunk_size, self.state.chunk_overlap)
         print("Transformed into nodes")
         save_nodes(nodes, input_dir)
         print("saved the nodes")
 
-def DocumentPreprocessingAgent(state: dict) -> OpenAIAgent:
-
-    def has_input_dir(input_dir) -> bool:
-        """Useful for checking if the user has specified an input file directory."""
-        print("Orchestrator checking if input file directory is specified")
-        state['input_dir'] = input_dir
-        print(f"Received the input directory {input_dir}")
-        return (state["input_dir"] is not None)
-
-    def has_chunk_size(chunk_size) -> bool:
-        """Useful for checking if the user has specified a chunk size."""
-        print("Orchestrator checking if chunk size is specified")
-        state['chunk_size'] = chunk_size
-        print(f"Received the Chunk size {chunk_size}")
-        return (state["chunk_size"] is not None)
-
-    def has_chunk_overlap(chunk_overlap) -> bool:
-        """Useful for checking if the user has specified a chunk overlap."""
-        print("Orchestrator checking if chunk overlap is specified")
-        state['chunk_overlap'] = chunk_overlap
-        print(f"Received the Chunk Overlap {chunk_overlap}")
-        return (state["chunk_overlap"] is not None)
+@cache_by_state
+def DocumentPreprocessingAgent(state: RAGState) -> OpenAIAgent:
+
+    def set_preprocessing_parameters(input_dir=None, chunk_size=None, chunk_overlap=None) -> List[str]:
+        """Useful for recording the input file directory, chunk size and chunk overlap supplied by the user.
+        Returns the parameters that are still missing."""
+        print("Recording the pre-processing parameters")
+        for key, value in (("input_dir", input_dir), ("chunk_size", chunk_size), ("chunk_overlap", chunk_overlap)):
+            if value is not None:
+                setattr(state, key, value)
+                print(f"Received the {key} {value}")
+        return get_missing_parameters(state)
 
     def done() -> None:
         """When you saved node to the output file, call this tool."""
         print("Document preprocessing is complete")
-        state["current_speaker"] = None
-        state["just_finished"] = True
+        state.current_speaker = None
+        state.just_finished = True
     
     doc_processor = preprocess_docs(state)
+    missing = get_missing_parameters(state)
     tools = [
-        FunctionTool.from_defaults(fn = has_input_dir),
-        FunctionTool.from_defaults(fn = has_chunk_size),
-        FunctionTool.from_defaults(fn = has_chunk_overlap),
+        FunctionTool.from_defaults(fn=set_preprocessing_parameters),
         FunctionTool.from_defaults(fn=doc_processor.process_documents),
         FunctionTool.from_defaults(fn=done),
     ]
@@ -113,12 +147,14 @@ def DocumentPreprocessingAgent(state: dict) -> OpenAIAgent:
     Your main responsibilities include transforming the documents, splitting them into nodes, and saving the nodes as a JSON file along with metadata in the specified directory.
     To accomplish this, you need the following parameters: the path to the directory containing the PDF files (input_dir), the chunk size, and the chunk overlap.
     
-    * If they want to pre-process the documents, but has_input_dir, has_chunk_size, or has_chunk_overlap returns false, Then You can ask the user to supply these.
+    The parameters that are still missing are: {missing}
+    * If the user supplies any of the parameters, record them with the tool "set_preprocessing_parameters" in a single call.
+    * If they want to pre-process the documents, but parameters are still missing, Then You can ask the user to supply these.
     
     Once the user supplies the input_dir, chunk_size, and chunk_overlap, use the tool "doc_processor.process_documents" to transform the documents, split them into nodes, and save the nodes in a JSON file.
     
     The current user state is:
-    {pprint.pformat(state, indent=4)}
+    {format_state(state)}
     
     After the documents are processed, split into nodes, and saved in the specified directory, call the tool "done" to signal completion. 
     If the user requests any action other than document preprocessing, call the tool "done" to indicate that another agent should take over.
@@ -126,13 +162,12 @@ def DocumentPreprocessingAgent(state: dict) -> OpenAIAgent:
 
     return OpenAIAgent.from_tools(
         tools,
-        llm=OpenAI(model="gpt-3.5-turbo"),
+        llm=_LLM,
         system_prompt=system_prompt,
     )
 
 
 if __name__ == '__main__':
-    state = {   
-    }
+    state = RAGState()
     agent = DocumentPreprocessingAgent(state)
     response = agent.chat("I want to pre-process the documents that are in this input directory ..\\data\\fine_tuning with a chunk size of 800 and a chunk overlap of 50")
@@ -1,19 +1,20 @@
-from llama_index.core.response_synthesizers import TreeSummarize
 from llama_index.core import PromptTemplate
 from llama_index.core import Settings
 from llama_index.core.query_engine import CustomQueryEngine
-from retriever_agent import Retriever
+from llama_index.core.base.response.schema import StreamingResponse
+from retriever_agent import get_retriever
 from llama_index.llms.openai import OpenAI
 from llama_index.agent.openai import OpenAIAgent
 from dotenv import load_dotenv
-from llama_index.core.response_synthesizers import BaseSynthesizer
 from llama_index.core.tools import FunctionTool
 import os
-import pprint
+from agent_state import RAGState, cache_by_state, format_state
 
 
 load_dotenv()
 
+_LLM = OpenAI(model="gpt-3.5-turbo")
+
 def prompt_template():
     """
     Define the prompt template for generating explanations based on the context and query.
@@ -42,84 +43,88 @@ def prompt_template():
     prompt_tmpl = PromptTemplate(prompt_str)
     return prompt_tmpl
 
-def prompt_generation(state):
+def prompt_generation(state: RAGState):
     """
     Generate the prompt for the given search type, query, and reranking model.
     """
-    state = state
-    retriever_agent = Retriever(state)
-    reranked_documents = retriever_agent.retriever()
+    query = state.query
+    retriever_agent = get_retriever(state.search_type, state.reranking_model)
+    reranked_documents = retriever_agent.retriever(query)
 
     context = "\n\n".join(reranked_documents)
-    query = state.get('query')
     prompt_templ = prompt_template().format(context_str=context, query_str=query)
 
     return prompt_templ
 
 class RAGStringQueryEngine(CustomQueryEngine):
     llm: OpenAI
-    #response_synthesizer: BaseSynthesizer
 
-    def custom_query(self, prompt: str) -> str:
+    def custom_query(self, prompt: str) -> StreamingResponse:
         """
-        Generate a response for the given prompt using the LLM and response synthesizer.
+        Stream the response for the given prompt from the LLM, token by token.
         """
-        response = self.llm.complete(prompt)
-        #summary = self.response_synthesizer.get_response(query_str=str(response), text_chunks=str(prompt))
-
-        return str(response)
+        completion_gen = self.llm.stream_complete(prompt)
+        return StreamingResponse(response_gen=(chunk.delta for chunk in completion_gen))
     
-def create_query_engine(prompt: str):
+def create_query_engine(prompt: str, stream: bool = False):
     """
     Create a query engine for generating responses based on the given prompt.
+    With stream, the tokens are also printed to stdout as they arrive.
     """
-    llm = OpenAI(model="gpt-3.5-turbo")
-    #response_synthesizer = TreeSummarize(llm=llm)
-
-    query_engine = RAGStringQueryEngine(
-        llm=llm,
-        #response_synthesizer=response_synthesizer,
-    )
+    query_engine = RAGStringQueryEngine(llm=_LLM)
     response = query_engine.query(prompt)
-    return response.response
-
-def generation(state):
+    if stream:
+        # Print the tokens as they arrive and collect the full answer for the agent
+        response.print_response_stream()
+        print()
+        return response.response_txt
+    return "".join(response.response_gen)
+
+def generation(state: RAGState, stream: bool = False):
     """
     Generate an explanation based on the given search type, query, and reranking model.
     """
     prompt = prompt_generation(state)
     print("Passing the ReRanked documents to the LLM")
-    response = create_query_engine(prompt)
+    response = create_query_engine(prompt, stream)
     print("Retrieved the response from LLMs")
 
     return response
 
 
-def GenerationAgent(state: dict) -> OpenAIAgent:
+def is_streamed_answer(agent_response) -> bool:
+    """
+    Check whether the agent response is the answer of generate_response, which was already streamed to stdout when the agent streams.
+    """
+    return bool(agent_response.sources) and agent_response.sources[-1].tool_name == "generate_response"
+
+@cache_by_state
+def GenerationAgent(state: RAGState, stream: bool = False) -> OpenAIAgent:
     """
     Define the GenerationAgent for generating explanations based on the user's query, search type, and reranking model.
+    With stream, the generated answer is printed to stdout token by token.
     """
 
     def has_reranking_model(reranking_model: str) -> bool:
         """Useful for checking if the user has specified a reranking model."""
         print("checking if reranking model is specified")
-        state['reranking_model'] = reranking_model
-        return (state["reranking_model"] is not None)
+        state.reranking_model = reranking_model
+        return (state.reranking_model is not None)
 
     def has_search_type(search_type: str) -> bool:
         """Useful for checking if the user has specified a search type."""
         print("checking if search type is specified")
-        state['search_type'] = search_type
-        return (state["search_type"] is not None)    
+        state.search_type = search_type
+        return (state.search_type is not None)    
 
     def has_query(query: str) -> bool:
         """Useful for checking if the user has specified query."""
         print("checking if query is specified")
-        state['query'] = query
-        return (state["query"] is not None)
+        state.query = query
+        return (state.query is not None)
 
-    def generate_response(state) -> str:
-        response = generation(state)
+    def generate_response() -> str:
+        response = generation(state, stream)
         print(state)
         #print(f"Response is generated and Here is the answer to your query:{response}")
         return response
@@ -128,8 +133,8 @@ def GenerationAgent(state: dict) -> OpenAIAgent:
         """
         Signal that the retrieval process is complete, update the state, and return the response to the user.
         """
-        state["current_speaker"] = None
-        state["just_finished"] = True
+        state.current_speaker = None
+        state.just_finished = True
 
     tools = [
         FunctionTool.from_defaults(fn=has_query),
@@ -147,7 +152,7 @@ def GenerationAgent(state: dict) -> OpenAIAgent:
         If the user supplies the necessary information, and make sure that has_query, has_search_type and has_reranking_model are not none,
         then call the tool "generate_response" using the provided details to perform the retrieval and generation process because it has the generation function.
         The current user state is:
-        {pprint.pformat(state, indent=4)}
+        {format_state(state)}
         When you have completed the generation process, call the tool "done" to signal that you are done.
         If the user asks to do anything other than retrieve documents, call the tool "done" with an empty string as an argument to signal that some other agent should help.
         """
@@ -155,21 +160,12 @@ def GenerationAgent(state: dict) -> OpenAIAgent:
 
     return OpenAIAgent.from_tools(
         tools = tools,
-        llm=OpenAI(model="gpt-3.5-turbo"),
+        llm=_LLM,
         system_prompt=system_prompt,
     )
 
 if __name__ == '__main__':
-    state = {   'chunk_overlap': None,
-    'chunk_size': None,
-    'current_speaker': None,
-    'embedding_model': None,
-    'input_dir': None,
-    'just_finished': False,
-    'query': 'what is self-RAG?',
-    'reranking_model': None,
-    'search_type': None,
-    }
+    state = RAGState(query='what is self-RAG?')
     agent = GenerationAgent(state=state)
     response = agent.chat("I want to query what is Recursive Introspection for Self-Improvement? with hybrid search type along with cross-encoder reranking model")
     print(response)
@@ -1,19 +1,20 @@
 from dotenv import load_dotenv
 import os
-import json
+import orjson
+from pathlib import Path
 from fastembed import SparseTextEmbedding, TextEmbedding
 from qdrant_client import QdrantClient, models
 from qdrant_client.http.models import PointStruct, SparseVector
 from tqdm import tqdm
 
-from typing import List
-import pprint
+from typing import List, Optional
 
 from llama_index.core.memory import ChatMemoryBuffer
 from llama_index.core.tools import FunctionTool
 from llama_index.llms.openai import OpenAI 
 from llama_index.agent.openai import OpenAIAgent
 from reranking_agent import ReRankingAgent
+from agent_state import RAGState, cache_by_state, format_state
 
 
 # Load environmental variables from a .env file
@@ -22,19 +23,22 @@ load_dotenv()
 Qdrant_API_KEY = os.getenv('Qdrant_API_KEY')
 Qdrant_URL = os.getenv('Qdrant_URL')
 Collection_Name = os.getenv('collection_name')
+_LLM = OpenAI(model="gpt-3.5-turbo")
 qdrant_client = QdrantClient(
                             url=Qdrant_URL,
-                            api_key=Qdrant_API_KEY)
+                            api_key=Qdrant_API_KEY,
+                            prefer_grpc=True,
+                            timeout=60)
         
         
 def load_nodes():
     metadata = []
     documents = []
-    payload_file = r'..\data\nodes.json'
+    payload_file = Path('..') / 'data' / 'nodes.json'
 
     try:
-        with open(payload_file, 'r') as file:
-            nodes = json.load(file)
+        with open(payload_file, 'rb') as file:
+            nodes = orjson.loads(file.read())
 
         for node in nodes:
             metadata.append(node['metadata'])
@@ -68,20 +72,18 @@ def client_collection():
                             on_disk=False,              
                         ),
                     )
-                }
+                },
+            # Skip building the HNSW graph during the bulk upload, it is built once afterwards
+            hnsw_config=models.HnswConfigDiff(m=0),
         )
         
     print(f"Created collection '{Collection_Name}' in Qdrant vector database.")
 
 
-def create_sparse_vector(sparse_embedding_model, text):
+def create_sparse_vector(embeddings):
     """
-    Create a sparse vector from the text using SPLADE.
+    Create a Qdrant sparse vector from a sparse embedding.
     """
-    sparse_embedding_model = sparse_embedding_model
-    # Generate the sparse vector using SPLADE model
-    embeddings = list(sparse_embedding_model.embed([text]))[0]
-
     # Check if embeddings has indices and values attributes
     if hasattr(embeddings, 'indices') and hasattr(embeddings, 'values'):
         sparse_vector = models.SparseVector(
@@ -98,41 +100,53 @@ Embeddings = {
     "BAAI": "BAAI/bge-large-en-v1.5",
 }
 
-def insert_documents(embedding_model, documents, metadata):
-    points = []
+BATCH_SIZE = 128
+PARALLEL = 4
+HNSW_M = 16
+
+def insert_documents(embedding_model, documents, metadata, batch_size=BATCH_SIZE, parallel=PARALLEL):
     embedding_model = TextEmbedding(model_name=Embeddings[embedding_model])
     sparse_embedding_model = SparseTextEmbedding(model_name="Qdrant/bm42-all-minilm-l6-v2-attentions")
-    for i, (doc, metadata) in enumerate(tqdm(zip(documents, metadata), total=len(documents))):
-        # Generate both dense and sparse embeddings
-        dense_embedding = list(embedding_model.embed([doc]))[0]
-        sparse_vector = create_sparse_vector(sparse_embedding_model, doc)
-
-        # Create PointStruct
-        point = models.PointStruct(
+    # Generate both dense and sparse embeddings in batches
+    dense_embeddings = embedding_model.embed(documents, batch_size=batch_size)
+    sparse_embeddings = sparse_embedding_model.embed(documents, batch_size=batch_size)
+    points = (
+        models.PointStruct(
             id=i,
             vector={
                 'dense': dense_embedding.tolist(),
-                'sparse': sparse_vector,
+                'sparse': create_sparse_vector(sparse_embedding),
             },
             payload={
                 'text': doc,
-                **metadata  # Include all metadata
+                **doc_metadata  # Include all metadata
             }
         )
-        points.append(point)
+        for i, (doc, doc_metadata, dense_embedding, sparse_embedding)
+        in enumerate(zip(documents, metadata, dense_embeddings, sparse_embeddings))
+    )
+
+    # Upload points in batches with parallel workers
+    qdrant_client.upload_points(
+        collection_name=Collection_Name,
+        points=tqdm(points, total=len(documents)),
+        batch_size=batch_size,
+        parallel=parallel,
+        # Wait until each batch is applied, so the points are searchable once indexing reports completion
+        wait=True,
+    )
 
-    # Upsert points
-    qdrant_client.upsert(
+    # Build the HNSW graph now that all the points are applied
+    qdrant_client.update_collection(
         collection_name=Collection_Name,
-        points=points
+        hnsw_config=models.HnswConfigDiff(m=HNSW_M),
     )
 
-    print(f"Upserted {len(points)} points with dense and sparse vectors into Qdrant vector database.")
+    print(f"Upserted {len(documents)} points with dense and sparse vectors into Qdrant vector database.")
 
 class Indexing:
-    def __init__(self, state: dict):
+    def __init__(self, state: RAGState):
         self.state = state
-        self.embedding_model = state.get('embedding_model')
     
     def indexing(self) -> None:
         """
@@ -142,27 +156,42 @@ class Indexing:
         documents, metadata = load_nodes()
         client_collection()
         print("Creation of the Qdrant Collection is Done")
-        insert_documents(self.embedding_model, documents, metadata)
+        # Read the settings now, they may have been recorded earlier in the same turn
+        batch_size = self.state.batch_size or BATCH_SIZE
+        parallel = self.state.parallel or PARALLEL
+        insert_documents(self.state.embedding_model, documents, metadata, batch_size, parallel)
         print("Indexing of the nodes is complete")
 
     
-def QdrantIndexingAgent(state: dict) -> OpenAIAgent:  
+@cache_by_state
+def QdrantIndexingAgent(state: RAGState) -> OpenAIAgent:  
 
     def has_embedding_model(embedding_model: str) -> bool:
         """Useful for checking if the user has specified an embedding model."""
         print("Orchestrator checking if embedding model is specified")
-        state['embedding_model'] = embedding_model
-        return (state["embedding_model"] is not None)
+        state.embedding_model = embedding_model
+        return (state.embedding_model is not None)
+
+    def has_upload_options(batch_size: Optional[int] = None, parallel: Optional[int] = None) -> dict:
+        """Useful for recording the upload batch size and/or number of parallel upload workers, if the user has specified them.
+        Returns the recorded upload options."""
+        print("checking if upload options are specified")
+        if batch_size is not None:
+            state.batch_size = batch_size
+        if parallel is not None:
+            state.parallel = parallel
+        return {"batch_size": state.batch_size, "parallel": state.parallel}
 
     def done() -> None:
         """When you inserted the vetors into the Qdrant Cluster, call this tool."""
         logging.info("Indexing of the nodes is complete and updating the state")
-        state["current_speaker"] = None
-        state["just_finished"] = True
+        state.current_speaker = None
+        state.just_finished = True
     
     Index = Indexing(state)
     tools = [
         FunctionTool.from_defaults(fn = has_embedding_model),
+        FunctionTool.from_defaults(fn = has_upload_options),
         FunctionTool.from_defaults(fn=Index.indexing),
         FunctionTool.from_defaults(fn=done),
     ]
@@ -173,29 +202,22 @@ def QdrantIndexingAgent(state: dict) -> OpenAIAgent:
     To proceed, you need to know which embedding model to use.
     
     * If the user intends to index the nodes but has not specified an embedding model (has_embedding_model is false), kindly prompt the user to provide the embedding model.
+    * The upload batch size and number of parallel workers are optional. Only call has_upload_options if the user specifies them, otherwise the defaults are used.
     
     Once the embedding model is provided, use the tool "Index.indexing" with the specified embedding model to index the nodes into the Qdrant cluster.
     The current user state is:
-    {pprint.pformat(state, indent=4)}
+    {format_state(state)}
     After successfully indexing the nodes into the Qdrant cluster, call the tool "done" to signal the completion of your task.
     If the user requests a task other than indexing the nodes, call the tool "done" to indicate that another agent should assist.
     """)
 
     return OpenAIAgent.from_tools(
         tools,
-        llm=OpenAI(model="gpt-3.5-turbo"),
+        llm=_LLM,
         system_prompt=system_prompt,
     )
 
 if __name__ == '__main__':
-    state= {   'chunk_overlap': None,
-    'chunk_size': None,
-    'current_speaker': 'indexing',
-    'embedding_model': None,
-    'input_dir': None,
-    'just_finished': False,
-    'query': None,
-    'reranking_model': None,
-    'search_type': None}
+    state = RAGState(current_speaker='indexing')
     agent = QdrantIndexingAgent(state = state)
     response = agent.chat("I want to index the nodes into the vector database using the sentence-transformer embedding model.")
\ No newline at end of file
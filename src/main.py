@@ -1,18 +1,23 @@
 from dotenv import load_dotenv
 load_dotenv()
 
+import asyncio
+import re
 from enum import Enum
-from typing import List
-import pprint
+from typing import List, Optional
 from colorama import Fore, Back, Style
 
-from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.memory import ChatSummaryMemoryBuffer
 from llama_index.core.tools import FunctionTool
 from llama_index.llms.openai import OpenAI 
 from llama_index.agent.openai import OpenAIAgent
 from document_pre_processing_agent import DocumentPreprocessingAgent
 from indexing_agent import QdrantIndexingAgent
-from generation_agent import GenerationAgent
+from generation_agent import GenerationAgent, is_streamed_answer
+from agent_state import RAGState, cache_by_state, format_state
+
+_LLM = OpenAI(model="gpt-3.5-turbo")
+_LLM_WARM = OpenAI(model="gpt-3.5-turbo", temperature=0.4)
 
 
 class Speaker(str, Enum):
@@ -25,7 +30,8 @@ class Speaker(str, Enum):
     ORCHESTRATOR = "orchestrator"
 
 
-def concierge_agent_factory(state: dict) -> OpenAIAgent:
+@cache_by_state
+def concierge_agent_factory(state: RAGState) -> OpenAIAgent:
     def dummy_tool() -> bool:
         """A tool that does nothing."""
         print("Doing nothing.")
@@ -43,16 +49,17 @@ def concierge_agent_factory(state: dict) -> OpenAIAgent:
         * generating a response to the user query using user preferred search type and reranking model.
 
         The current state of the user is:
-        {pprint.pformat(state, indent=4)}
+        {format_state(state)}
     """)
 
     return OpenAIAgent.from_tools(
         tools,
-        llm=OpenAI(model="gpt-3.5-turbo"),
+        llm=_LLM,
         system_prompt=system_prompt,
     )
 
-def continuation_agent_factory(state: dict) -> OpenAIAgent:
+@cache_by_state
+def continuation_agent_factory(state: RAGState) -> OpenAIAgent:
     def dummy_tool() -> bool:
         """A tool that does nothing."""
         print("Doing nothing.")
@@ -63,63 +70,52 @@ def continuation_agent_factory(state: dict) -> OpenAIAgent:
 
     system_prompt = (f"""
         The current state of the user is:
-        {pprint.pformat(state, indent=4)}
+        {format_state(state)}
     """)
 
     return OpenAIAgent.from_tools(
         tools,
-        llm=OpenAI(model="gpt-3.5-turbo", temperature=0.4),
+        llm=_LLM_WARM,
         system_prompt=system_prompt,
     )
 
-def orchestration_agent_factory(state: dict) -> OpenAIAgent:
-    
-    def has_embedding_model(embedding_model: str) -> bool:
-        """Useful for checking if the user has specified an embedding model."""
-        print("Orchestrator checking if embedding model is specified")
-        state['embedding_model'] = embedding_model
-        return (state["embedding_model"] is not None)
-    def has_reranking_model(reranking_model: str) -> bool:
-        """Useful for checking if the user has specified a reranking model."""
-        print("checking if reranking model is specified")
-        state['reranking_model'] = reranking_model
-        return (state["reranking_model"] is not None)
-
-    def has_search_type(search_type: str) -> bool:
-        """Useful for checking if the user has specified a search type."""
-        print("checking if search type is specified")
-        state['search_type'] = search_type
-        return (state["search_type"] is not None)    
-
-    def has_query(query: str) -> bool:
-        """Useful for checking if the user has specified query."""
-        print("checking if query is specified")
-        state['query'] = query
-        return (state["query"] is not None)
-      
+REQUIRED_FIELDS = {
+    Speaker.Data_pre_processing: ("input_dir", "chunk_size", "chunk_overlap"),
+    Speaker.Indexing: ("embedding_model",),
+    Speaker.Generation: ("query", "search_type", "reranking_model"),
+}
+
+def get_missing_fields(state: RAGState) -> List[str]:
+    """Return the required state fields that have not been specified yet."""
+    return [field for fields in REQUIRED_FIELDS.values() for field in fields if getattr(state, field) is None]
+
+@cache_by_state
+def orchestration_agent_factory(state: RAGState) -> OpenAIAgent:
+
+    def get_missing() -> List[str]:
+        """Useful for checking which of the user's settings are still missing."""
+        print("Orchestrator checking which settings are missing")
+        return get_missing_fields(state)
 
     tools = [
-        FunctionTool.from_defaults(fn=has_embedding_model),
-        FunctionTool.from_defaults(fn=has_query),
-        FunctionTool.from_defaults(fn=has_search_type),
-        FunctionTool.from_defaults(fn=has_reranking_model),
+        FunctionTool.from_defaults(fn=get_missing),
     ]
 
+    missing = get_missing_fields(state)
+
     system_prompt =  (f"""
         You are the orchestration agent.
-        Your job is to decide which agent to run based on the current state of the user and what they've asked to do. Agents are identified by short strings.
+        Your job is to decide which agent to run based on the settings that are still missing and what the user has asked to do. Agents are identified by short strings.
         What you do is return the name of the agent to run next. You do not do anything else.
 
-        The current state of the user is:
-        {pprint.pformat(state, indent=4)}
-
-        If a current_speaker is already selected in the state, simply output that value.
+        The settings that are still missing from the state are: {missing}
+        If the user has supplied some of them since, call the tool "get_missing" to check which are still missing.
 
-        If there is no current_speaker value, look at the chat history and the current state and you MUST return one of these strings identifying an agent to run:
+        Look at the chat history and the missing settings, and you MUST return one of these strings identifying an agent to run:
         * "{Speaker.Data_pre_processing.value}" - if the user wants to pre-process the documents into nodes
-            * If they want to pre-process the documents, but has_input_dir, has_chunk_size, or has_chunk_overlap returns false, return "{Speaker.Concierge.value}" instead
+            * If they want to pre-process the documents, but input_dir, chunk_size, or chunk_overlap is missing and the user has not supplied it, return "{Speaker.Concierge.value}" instead
         * "{Speaker.Indexing.value}" - if the user wants to index the nodes into qdrant vector database
-            * If they want to index the nodes, but has_embedding_model returns false, return "{Speaker.Concierge.value}" instead
+            * If they want to index the nodes, but embedding_model is missing and the user has not supplied it, return "{Speaker.Concierge.value}" instead
         * "{Speaker.Generation.value}" - if the user wants to query the documents (requires query, search type, and reranking model)          
         * "{Speaker.Concierge.value}" - if the user wants to do something else, or hasn't said what they want to do, or you can't figure out what they want to do. Choose this by default.
 
@@ -129,29 +125,59 @@ def orchestration_agent_factory(state: dict) -> OpenAIAgent:
 
     return OpenAIAgent.from_tools(
         tools,
-        llm=OpenAI(model="gpt-3.5-turbo", temperature=0.4),
+        llm=_LLM_WARM,
         system_prompt=system_prompt,
     )
 
-def get_initial_state() -> dict:
-    return {
-        "input_dir": None,
-        "chunk_size": None,
-        "chunk_overlap": None,
-        "embedding_model": None,
-        "reranking_model": None,
-        "search_type": None,
-        "query": None,
-        "current_speaker": None,
-        "just_finished": False,
-        "response": None,
-    }
-
-
-def run() -> None:
-    state = get_initial_state()
-
-    root_memory = ChatMemoryBuffer.from_defaults(token_limit=80000)
+# Rule-based routing only fires on explicit requests for a single stage, for example:
+#   "index the nodes"                                   -> indexing (if embedding_model is set)
+#   "Please re-index the nodes"                         -> indexing (if embedding_model is set)
+#   "I want to pre-process the documents"               -> data_pre_processing (if its settings are set)
+#   "query what is RAFT"                                -> generation (if its settings are set)
+#   "I already indexed the nodes, what is self-RAG?"    -> None, not a request to index
+#   "I want to index the nodes and then query them"     -> None, mentions another stage
+#   "what is self-RAG?"                                 -> None, left to the orchestration agent
+_REQUEST_PREFIX = r"^\s*(?:please\s+|(?:i\s+)?(?:want|would\s+like|need)\s+to\s+|i'?d\s+like\s+to\s+|can\s+you\s+)?"
+
+INTENT_PATTERNS = {
+    Speaker.Data_pre_processing: re.compile(_REQUEST_PREFIX + r"(?:re-?)?pre-?process\b", re.IGNORECASE),
+    Speaker.Indexing: re.compile(_REQUEST_PREFIX + r"(?:re-?)?index\b", re.IGNORECASE),
+    Speaker.Generation: re.compile(_REQUEST_PREFIX + r"query\b", re.IGNORECASE),
+}
+
+STAGE_MENTIONS = {
+    Speaker.Data_pre_processing: re.compile(r"pre-?process", re.IGNORECASE),
+    Speaker.Indexing: re.compile(r"index", re.IGNORECASE),
+    Speaker.Generation: re.compile(r"quer", re.IGNORECASE),
+}
+
+def route_by_rules(state: RAGState, user_msg_str: str) -> Optional[Speaker]:
+    """
+    Pick the next speaker without the orchestration agent when the turn is unambiguous:
+    the message explicitly asks for one stage, mentions no other stage,
+    and every setting that stage needs is already in the state.
+    Returns None when the orchestration agent has to decide.
+    """
+    intents = [speaker for speaker, pattern in INTENT_PATTERNS.items() if pattern.search(user_msg_str)]
+    if len(intents) != 1:
+        return None
+    speaker = intents[0]
+    mentioned = [other for other, pattern in STAGE_MENTIONS.items() if pattern.search(user_msg_str)]
+    if mentioned != [speaker]:
+        return None
+    if any(getattr(state, field) is None for field in REQUIRED_FIELDS[speaker]):
+        return None
+    return speaker
+
+def get_root_memory() -> ChatSummaryMemoryBuffer:
+    # Older turns are summarized so the history passed to every agent stays bounded
+    return ChatSummaryMemoryBuffer.from_defaults(llm=_LLM, token_limit=2000)
+
+
+async def run() -> None:
+    state = RAGState()
+
+    root_memory = get_root_memory()
 
     first_run = True
     is_retry = False
@@ -164,9 +190,9 @@ def run() -> None:
         elif is_retry == True:
             user_msg_str = "That's not right, try again. Pick one agent."
             is_retry = False
-        elif state["just_finished"] == True:
+        elif state.just_finished == True:
             print("Asking the continuation agent to decide what to do next")
-            user_msg_str = str(continuation_agent_factory(state).chat("""
+            user_msg_str = str(await continuation_agent_factory(state).achat("""
                 Look at the chat history to date and figure out what the user was originally trying to do.
                 They might have had to do some sub-tasks to complete that task, but what we want is the original thing they started out trying to do.
                 Formulate a sentence as if written by the user that asks to continue that task.
@@ -174,24 +200,27 @@ def run() -> None:
             """, chat_history=current_history))
             print(f"Continuation agent said {user_msg_str}")
             if user_msg_str == "no_further_task":
-                user_msg_str = input(">> ").strip()
+                user_msg_str = (await asyncio.to_thread(input, ">> ")).strip()
                 if user_msg_str.lower() == "exit":
                     print("Exiting the conversation...")
                     should_continue = False
-            state["just_finished"] = False
+            state.just_finished = False
         else:
-            user_msg_str = input("> ").strip()
+            user_msg_str = (await asyncio.to_thread(input, "> ")).strip()
             if user_msg_str.lower() == "exit":
                 print("Exiting the conversation...")
                 should_continue = False
-        current_history = root_memory.get()
-
-        if (state["current_speaker"]):
-            print(f"There's already a speaker: {state['current_speaker']}")
-            next_speaker = state["current_speaker"]
+        # Summarizing older turns is a blocking LLM call, keep it off the event loop
+        current_history = await asyncio.to_thread(root_memory.get)
+
+        if (state.current_speaker):
+            print(f"There's already a speaker: {state.current_speaker}")
+            next_speaker = state.current_speaker
+        elif (next_speaker := route_by_rules(state, user_msg_str)):
+            print(f"Routed to {next_speaker.value} without the orchestration agent")
         else:
             print("No current speaker, asking orchestration agent to decide")
-            orchestration_response = orchestration_agent_factory(state).chat(user_msg_str, chat_history=current_history)
+            orchestration_response = await orchestration_agent_factory(state).achat(user_msg_str, chat_history=current_history)
             next_speaker = str(orchestration_response).strip()
 
         print(f"Next speaker: {next_speaker}")
@@ -199,15 +228,15 @@ def run() -> None:
         if next_speaker == Speaker.Data_pre_processing:
             print("Data pre-processing agent selected")
             current_speaker = DocumentPreprocessingAgent(state)
-            state["current_speaker"] = next_speaker
+            state.current_speaker = next_speaker
         elif next_speaker == Speaker.Indexing:
             print("indexing agent is selected")
             current_speaker = QdrantIndexingAgent(state)
-            state["current_speaker"] = next_speaker
+            state.current_speaker = next_speaker
         elif next_speaker == Speaker.Generation:
             print("Generation agent is selected")
-            current_speaker = GenerationAgent(state)
-            state["current_speaker"] = next_speaker
+            current_speaker = GenerationAgent(state, stream=True)
+            state.current_speaker = next_speaker
         elif next_speaker == Speaker.Concierge:
             print("Concierge agent selected")
             current_speaker = concierge_agent_factory(state)
@@ -216,13 +245,13 @@ def run() -> None:
             is_retry = True
             continue
 
-        pretty_state = pprint.pformat(state, indent=4)
-        
-        print(f"State: {pretty_state}")
+        print(f"State: {format_state(state)}")
 
         
-        response = current_speaker.chat(user_msg_str, chat_history=current_history)
-        print(str(response))
+        response = await current_speaker.achat(user_msg_str, chat_history=current_history)
+        # A generated answer has already been streamed to the console
+        if not is_streamed_answer(response):
+            print(str(response))
 
         
         new_history = current_speaker.memory.get_all()
@@ -230,4 +259,4 @@ def run() -> None:
 
 if __name__ == '__main__':
     print("Testing the Application")
-    run()
\ No newline at end of file
+    asyncio.run(run())
\ No newline at end of file
@@ -1,4 +1,5 @@
 import logging
+import functools
 from dotenv import load_dotenv
 import os
 from fastembed import SparseTextEmbedding, TextEmbedding
@@ -8,7 +9,6 @@ from typing import List, Union
 from sentence_transformers import CrossEncoder
 
 from typing import List
-import pprint
 
 from llama_index.core.memory import ChatMemoryBuffer
 from llama_index.core.tools import FunctionTool
@@ -16,6 +16,7 @@ from llama_index.llms.openai import OpenAI
 from llama_index.agent.openai import OpenAIAgent
 from pydantic import BaseModel
 from reranking_agent import ReRankingAgent
+from agent_state import RAGState, format_state
 
 
 # Load environment variables
@@ -30,22 +31,23 @@ class SearchStrategy:
         raise NotImplementedError
 
 class SemanticSearch(SearchStrategy):
-    def query_semantic_search(self, query: str) -> List[str]:
+    def __init__(self):
         # Load the dense embedding model
-        embedding_model = TextEmbedding(model_name="sentence-transformers/all-MiniLM-L6-v2")
+        self.embedding_model = TextEmbedding(model_name="sentence-transformers/all-MiniLM-L6-v2")
 
         # Initialize the Qdrant client
-        qdrant_client = QdrantClient(
+        self.qdrant_client = QdrantClient(
             url=Qdrant_URL,
             api_key=Qdrant_API_KEY,
             timeout=30
         )
 
+    def query_semantic_search(self, query: str) -> List[str]:
         # Embed the query using the dense embedding model
-        dense_query = list(embedding_model.embed([query]))[0].tolist()
+        dense_query = list(self.embedding_model.embed([query]))[0].tolist()
 
         # Perform the semantic search
-        results = qdrant_client.query_points(
+        results = self.qdrant_client.query_points(
                 collection_name=Collection_Name,
                 query=dense_query,
                 using="dense",
@@ -57,23 +59,23 @@ class SemanticSearch(SearchStrategy):
         return documents
 
 class HybridSearch(SearchStrategy):
-    def query_hybrid_search(self, query: str) -> List[str]:
-
-        embedding_model = TextEmbedding(model_name="sentence-transformers/all-MiniLM-L6-v2")
-        sparse_embedding_model = SparseTextEmbedding(model_name="Qdrant/bm42-all-minilm-l6-v2-attentions")
-        qdrant_client = QdrantClient(
+    def __init__(self):
+        self.embedding_model = TextEmbedding(model_name="sentence-transformers/all-MiniLM-L6-v2")
+        self.sparse_embedding_model = SparseTextEmbedding(model_name="Qdrant/bm42-all-minilm-l6-v2-attentions")
+        self.qdrant_client = QdrantClient(
             url=Qdrant_URL,
             api_key=Qdrant_API_KEY,
             timeout=30
         )
 
+    def query_hybrid_search(self, query: str) -> List[str]:
         # Embed the query using the dense embedding model
-        dense_query = list(embedding_model.embed([query]))[0].tolist()
+        dense_query = list(self.embedding_model.embed([query]))[0].tolist()
 
         # Embed the query using the sparse embedding model
-        sparse_query = list(sparse_embedding_model.embed([query]))[0]
+        sparse_query = list(self.sparse_embedding_model.embed([query]))[0]
 
-        results = qdrant_client.query_points(
+        results = self.qdrant_client.query_points(
             collection_name=Collection_Name,
             prefetch=[
                 models.Prefetch(
@@ -127,33 +129,38 @@ def get_search_strategy(search_type: str) -> SearchStrategy:
         raise ValueError("Invalid search type")
 
 class Retriever:
-    def __init__(self, state: dict):
-        self.state = state
-        self.search_type = state.get('search_type')
-        self.query = state.get('query')
-        self.reranking_model = state.get('reranking_model')
+    def __init__(self, search_type: str, reranking_model: str):
+        self.search_type = search_type
+        self.reranking_model = reranking_model
+        self.search_strategy = get_search_strategy(search_type)
 
-    def retriever(self):
+    def retriever(self, query: str):
         """
         Perform the search and retrieval process based on the specified search type, query, and reranking model.
         """
         print("Starting the search and retrieval process")
-        search_strategy = get_search_strategy(self.search_type)
         if self.search_type == 'semantic':
-            documents = search_strategy.query_semantic_search(self.query)
+            documents = self.search_strategy.query_semantic_search(query)
         elif self.search_type == 'hybrid':
-            documents = search_strategy.query_hybrid_search(self.query)
+            documents = self.search_strategy.query_hybrid_search(query)
         else:
             raise ValueError("Invalid search type")
         print("Search and retrieval process completed")
-        reranked_documents = ReRankingAgent(self.query, documents, self.reranking_model)
+        reranked_documents = ReRankingAgent(query, documents, self.reranking_model)
         print("Reranking of the retrieved documents is complete")
 
         return reranked_documents
 
+@functools.lru_cache(maxsize=8)
+def get_retriever(search_type: str, reranking_model: str) -> Retriever:
+    """
+    Return a Retriever for the search type and reranking model, reusing its embedding models and Qdrant client across queries.
+    """
+    return Retriever(search_type, reranking_model)
+
 
 # RetrieverAgent function
-def RetrieverAgent(state: dict) -> OpenAIAgent:
+def RetrieverAgent(state: RAGState) -> OpenAIAgent:
 
 
     def done() -> None:
@@ -161,13 +168,17 @@ def RetrieverAgent(state: dict) -> OpenAIAgent:
         Signal that the retrieval process is complete and update the state.
         """
         logging.info("Retrieval process is complete and updating the state")
-        state["current_speaker"] = None
-        state["just_finished"] = True
-    
-    retriever = Retriever(state)
+        state.current_speaker = None
+        state.just_finished = True
+
+    def retriever() -> List[str]:
+        """
+        Perform the search and retrieval process based on the specified search type, query, and reranking model.
+        """
+        return get_retriever(state.search_type, state.reranking_model).retriever(state.query)
 
     tools = [
-        FunctionTool.from_defaults(fn=retriever.retriever),
+        FunctionTool.from_defaults(fn=retriever),
         FunctionTool.from_defaults(fn=done),
     ]
 
@@ -178,7 +189,7 @@ def RetrieverAgent(state: dict) -> OpenAIAgent:
     You can ask the user to supply these details.
     If the user supplies the necessary information, then call the tool "retriever" using the provided details to perform the search and retrieval process.
     The current user state is:
-    {pprint.pformat(state, indent=4)}
+    {format_state(state)}
     When you have completed the retrieval process, call the tool "done" to signal that you are done.
     If the user asks to do anything other than retrieve documents, call the tool "done" to signal that some other agent should help.
     """)
@@ -189,16 +200,7 @@ def RetrieverAgent(state: dict) -> OpenAIAgent:
         system_prompt=system_prompt,
     )
 if __name__ == '__main__':
-    state = {   'chunk_overlap': None,
-    'chunk_size': None,
-    'current_speaker': None,
-    'embedding_model': None,
-    'input_dir': None,
-    'just_finished': False,
-    'query': 'what is self-RAG?',
-    'reranking_model': None,
-    'search_type': 'None',
-    }
+    state = RAGState(query='what is self-RAG?', search_type='None')
     agent = RetrieverAgent(state = state)
     response = agent.chat("I want to query what is Adaptive-RAG?")
     print(response)